@@ -1,15 +1,26 @@
 import os
+import gzip
 import json
 import time
+import uuid
+import random
 import logging
+import tempfile
+import threading
 import snowflake.connector
 from datetime import datetime, timedelta, timezone
 from google.oauth2 import service_account
+import google.auth.transport.requests
+from google_auth_httplib2 import AuthorizedHttp
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
+from googleapiclient.http import build_http
+from googleapiclient.model import JsonModel
 from google.auth.exceptions import RefreshError
+from collections import defaultdict
 from concurrent.futures import ThreadPoolExecutor, as_completed
-import base64
+import binascii
+import orjson
 
 # Load environment variables from .env file
 from dotenv import load_dotenv
@@ -41,9 +52,105 @@ credentials = service_account.Credentials.from_service_account_file(
 # Configure logging
 logging.basicConfig(filename='email_fetch_errors.log', level=logging.ERROR)
 
+# Google advises at most 50 sub-requests per Gmail batch; 50 messages.get calls
+# cost 250 quota units, the per-user limit per second
+BATCH_SIZE = 50
+
+# Partial response for messages.get: only the MIME structure and body data are used
+MESSAGE_FIELDS = 'id,payload(mimeType,parts(mimeType,body/data,parts),body/data)'
+
+# Delegated credentials keyed by user_email, shared by all threads; the
+# per-user locks keep users refreshing in parallel without duplicate refreshes
+_cred_cache = {}
+_cred_locks = defaultdict(threading.Lock)
+
+# Access tokens live for an hour; refresh them once less than this remains
+TOKEN_REFRESH_MARGIN = timedelta(minutes=5)
+
+def get_delegated_credentials(user_email):
+    """Return refreshed delegated credentials for user_email, reusing the cached token until it nears expiry."""
+    with _cred_locks[user_email]:
+        delegated_credentials = _cred_cache.get(user_email)
+        # google-auth keeps expiry as a naive UTC datetime
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        if delegated_credentials is None or delegated_credentials.expiry - now < TOKEN_REFRESH_MARGIN:
+            # Delegate the credentials to the user
+            delegated_credentials = credentials.with_subject(user_email)
+            delegated_credentials.refresh(google.auth.transport.requests.Request())
+            _cred_cache[user_email] = delegated_credentials
+        return delegated_credentials
+
+class OrjsonModel(JsonModel):
+    """JsonModel that parses Gmail API responses with orjson instead of the stdlib json module."""
+
+    def deserialize(self, content):
+        try:
+            body = orjson.loads(content)
+        except orjson.JSONDecodeError:
+            # Same fallback as JsonModel: hand back non-JSON content as text
+            return content.decode('utf-8') if isinstance(content, bytes) else content
+        if self._data_wrapper and 'data' in body:
+            body = body['data']
+        return body
+
+# Gmail services keyed by (user_email, thread id) and keep-alive connections keyed
+# by thread id; httplib2 objects are not thread-safe
+_gmail_services = {}
+_http_connections = {}
+
+def get_http_connection():
+    """Return the calling thread's httplib2 connection, shared by all of its Gmail services."""
+    key = threading.get_ident()
+    http = _http_connections.get(key)
+    if http is None:
+        http = build_http()
+        _http_connections[key] = http
+    return http
+
+def get_gmail_service(user_email):
+    """Return the calling thread's Gmail service for user_email, building it on first use."""
+    key = (user_email, threading.get_ident())
+    gmail_service = _gmail_services.get(key)
+    if gmail_service is None:
+        delegated_credentials = get_delegated_credentials(user_email)
+        http = AuthorizedHttp(delegated_credentials, http=get_http_connection())
+        # Use the discovery document bundled with the client instead of fetching it
+        gmail_service = build('gmail', 'v1', http=http, model=OrjsonModel(), static_discovery=True)
+        _gmail_services[key] = gmail_service
+    return gmail_service
+
+# 403 reasons that mean "slow down" rather than a permanent permission error
+RATE_LIMIT_REASONS = ('ratelimitexceeded', 'userratelimitexceeded')
+
+def is_rate_limit_error(error):
+    """Return True if an HttpError is a 429 or a rate-limit 403 that is worth retrying."""
+    if error.resp.status == 429:
+        return True
+    if error.resp.status != 403 or not isinstance(error.error_details, list):
+        return False
+    # Gmail reports the reason as e.g. rateLimitExceeded or RATE_LIMIT_EXCEEDED
+    return any(
+        isinstance(detail, dict) and detail.get('reason', '').replace('_', '').lower() in RATE_LIMIT_REASONS
+        for detail in error.error_details
+    )
+
+def backoff_delay(attempt, max_backoff=32):
+    """Return the truncated exponential backoff delay, with jitter, before retry number attempt."""
+    return min(2 ** attempt + random.random(), max_backoff)
+
+def execute_with_backoff(request, max_retries=5):
+    """Execute a Gmail API request, retrying rate-limit errors with truncated exponential backoff."""
+    for attempt in range(max_retries):
+        try:
+            return request.execute()
+        except HttpError as error:
+            if not is_rate_limit_error(error) or attempt == max_retries - 1:
+                raise
+            time.sleep(backoff_delay(attempt))
+
 def list_messages(user_email, max_results=100):
-    """List messages in the user's mailbox with pagination for the previous day."""
-    all_messages = []
+    """Yield pages of messages in the user's mailbox for the previous day, up to max_results in total."""
+    listed = 0
     page_token = None
 
     # Calculate the date for 'yesterday'
@@ -52,149 +159,242 @@ def list_messages(user_email, max_results=100):
     # Query for emails only from the previous day
     query = f"after:{yesterday} before:{today}"
 
-    # Delegate the credentials to the user
-    delegated_credentials = credentials.with_subject(user_email)
-    gmail_service = build('gmail', 'v1', credentials=delegated_credentials)
+    gmail_service = get_gmail_service(user_email)
 
-    while len(all_messages) < max_results:
+    while listed < max_results:
         try:
-            results = gmail_service.users().messages().list(
+            results = execute_with_backoff(gmail_service.users().messages().list(
                 userId='me',
                 pageToken=page_token,
+                fields='nextPageToken,messages/id',  # Only the ids are needed
                 q=query,  # Query for filtering by date
-                maxResults=min(500, max_results - len(all_messages))  # Gmail API supports max 500
-            ).execute()
-            
-            messages = results.get('messages', [])
-            all_messages.extend(messages)
-
-            page_token = results.get('nextPageToken')
-            if not page_token:
-                break
-
-            # Avoid hitting rate limits
-            time.sleep(0.5)
+                maxResults=min(500, max_results - listed)  # Gmail API supports max 500
+            ))
         except HttpError as error:
             logging.error(f"An error occurred while listing messages for {user_email}: {error}")
             break
 
-    return all_messages
+        messages = results.get('messages', [])
+        listed += len(messages)
+        yield messages
+
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            break
+
+
+# Maps the URL-safe base64 alphabet Gmail uses onto the standard one
+_TBL = bytes.maketrans(b'-_', b'+/')
+
+def decode_body(data):
+    """Decode a base64url body from the Gmail API into text."""
+    raw = data.encode('ascii').translate(_TBL)
+    # Padding may be missing; a2b_base64 ignores any excess
+    return binascii.a2b_base64(raw + b'==').decode('utf-8', errors='replace')
 
+def find_body(part):
+    """Walk a MIME part tree and return ('plain' | 'html', data) for the best body, or None."""
+    data = part.get('body', {}).get('data')
+    if part.get('mimeType') == 'text/plain' and data:
+        return ('plain', data)  # Stop at the first found plain text part
 
-def get_message_details(message_id, user_email, retries=3):
-    """Get only the id and email body of a specific message."""
-    delegated_credentials = credentials.with_subject(user_email)
-    gmail_service = build('gmail', 'v1', credentials=delegated_credentials)
+    # Keep the first text/html as a fallback while looking for text/plain
+    best = ('html', data) if part.get('mimeType') == 'text/html' and data else None
+    for child in part.get('parts', []):
+        found = find_body(child)
+        if found and found[0] == 'plain':
+            return found
+        if found and best is None:
+            best = found
+    return best
 
-    for attempt in range(retries):
+def extract_message_details(message):
+    """Build the id and email body record from a fetched message."""
+    payload = message.get('payload', {})
+
+    # Initialize details with only id and email body
+    details = {
+        'id': message['id'],
+        'email_body': ''
+    }
+
+    # Extract the email body from the payload, searching nested multiparts too
+    body = find_body(payload)
+    if body:
+        details['email_body'] = decode_body(body[1])
+    elif payload.get('body', {}).get('data'):
+        # If no text parts, the body is in the 'body' key directly
+        details['email_body'] = decode_body(payload['body']['data'])
+
+    return details
+
+def get_message_details(gmail_service, message_ids, user_email, max_retries=5):
+    """Get the id and email body of up to BATCH_SIZE messages in a single batch HTTP request."""
+    email_details = []
+    pending = list(message_ids)
+
+    for attempt in range(max_retries):
+        throttled = []
+
+        def handle_response(message_id, message, exception):
+            if exception is not None:
+                if isinstance(exception, HttpError) and is_rate_limit_error(exception):
+                    throttled.append(message_id)
+                else:
+                    # Permanent failures, e.g. a message deleted after it was listed
+                    logging.error(f"An error occurred while getting details for message {message_id} from {user_email}: {exception}")
+                return
+            try:
+                email_details.append(extract_message_details(message))
+            except Exception as exc:
+                logging.error(f"An error occurred while parsing message {message_id} from {user_email}: {exc}")
+
+        batch = gmail_service.new_batch_http_request(callback=handle_response)
+        for message_id in pending:
+            batch.add(gmail_service.users().messages().get(
+                userId='me',
+                id=message_id,
+                format='full',
+                fields=MESSAGE_FIELDS  # Only the parts needed to extract the body
+            ), request_id=message_id)
         try:
-            message = gmail_service.users().messages().get(
-                userId='me', 
-                id=message_id
-            ).execute()
-            payload = message.get('payload', {})
-            
-            # Initialize details with only id and email body
-            details = {
-                'id': message_id,
-                'email_body': '',
-                'inserted_date': datetime.now(timezone.utc).strftime('%Y-%m-%d')
-            }
-
-            # Extract the email body from the payload
-            if 'parts' in payload:
-                for part in payload['parts']:
-                    mime_type = part.get('mimeType')
-                    if mime_type == 'text/plain':
-                        details['email_body'] = base64.urlsafe_b64decode(part['body']['data']).decode('utf-8')
-                        break  # Stop at the first found plain text part
-                    elif mime_type == 'text/html':
-                        details['email_body'] = base64.urlsafe_b64decode(part['body']['data']).decode('utf-8')
-            else:
-                # If no parts, the body is in the 'body' key directly
-                details['email_body'] = base64.urlsafe_b64decode(payload['body']['data']).decode('utf-8')
-            
-            return details
+            batch.execute()
         except HttpError as error:
-            logging.error(f"Attempt {attempt+1}: An error occurred while getting details for message {message_id} from {user_email}: {error}")
-            time.sleep(2)  # Wait before retrying
+            if not is_rate_limit_error(error):
+                logging.error(f"An error occurred while getting details for {len(pending)} messages from {user_email}: {error}")
+                return email_details
+            throttled = pending
 
-    logging.error(f"Failed to fetch details for message {message_id} from {user_email} after {retries} attempts.")
-    return None
+        if not throttled:
+            return email_details
+        pending = throttled
+        if attempt < max_retries - 1:
+            time.sleep(backoff_delay(attempt))
 
-def save_to_snowflake(data, conn, batch_size=1000):
-    """Save the id and email body to the Snowflake EMAIL_BODIES_TEST table in batches."""
+    for message_id in pending:
+        logging.error(f"Failed to fetch details for message {message_id} from {user_email}: still rate limited after {max_retries} attempts.")
+    return email_details
+
+def save_to_snowflake(data, conn, batch_size=16000):
+    """Bulk load the id and email body into the Snowflake TEST123 table via staged NDJSON files and COPY INTO."""
     if data:
+        # The current date is the same for every row, so compute it once
+        inserted_date = datetime.now(timezone.utc).strftime('%Y-%m-%d')
         cursor = conn.cursor()
-        batch = []
-        for row in data:
-            row['inserted_date'] = datetime.now(timezone.utc).strftime('%Y-%m-%d')
-            batch.append(row)
-            if len(batch) >= batch_size:
-                cursor.executemany(
-                    """
-                    INSERT INTO TEST123 (id, email_body, inserted_date)
-                    VALUES (%(id)s, %(email_body)s, %(inserted_date)s)
-                    """,
-                    batch
-                )
-                batch = []
-        if batch:
-            cursor.executemany(
-                """
-                INSERT INTO TEST123 (id, email_body, inserted_date)
-                VALUES (%(id)s, %(email_body)s, %(inserted_date)s)
-                """,
-                batch
-            )
+        # A per-run stage path keeps concurrent runs from overwriting or purging each other's files
+        stage_path = f'@~/email_stage/{uuid.uuid4()}'
+        load_files = []
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # Split the rows across files so PUT uploads and COPY loads them in parallel
+            for start in range(0, len(data), batch_size):
+                load_file = f'test123_load_{start // batch_size}.json.gz'
+                with gzip.open(os.path.join(tmp_dir, load_file), 'wt', encoding='utf-8') as f:
+                    for row in data[start:start + batch_size]:
+                        f.write(json.dumps({'id': row['id'], 'email_body': row['email_body'], 'inserted_date': inserted_date}) + '\n')
+                load_files.append(load_file)
+            cursor.execute(f"PUT 'file://{tmp_dir}/test123_load_*.json.gz' {stage_path} AUTO_COMPRESS=FALSE OVERWRITE=TRUE PARALLEL=8")
+        files = ', '.join(f"'{load_file}'" for load_file in load_files)
+        cursor.execute(
+            f"""
+            COPY INTO TEST123
+            FROM {stage_path}
+            FILES = ({files})
+            FILE_FORMAT = (TYPE = JSON)
+            MATCH_BY_COLUMN_NAME = CASE_INSENSITIVE
+            PURGE = TRUE
+            """
+        )
         conn.commit()
         cursor.close()
 
-def fetch_details_concurrently(messages, user_email):
-    """Fetch message details concurrently."""
+def load_existing_ids(conn):
+    """Return the ids loaded into the Snowflake TEST123 table over the last two days."""
+    cursor = conn.cursor()
+    cursor.execute("SELECT id FROM TEST123 WHERE inserted_date >= DATEADD(day, -2, CURRENT_DATE())")
+    existing_ids = {row[0] for row in cursor}
+    cursor.close()
+    return existing_ids
+
+def fetch_details_concurrently(pages, user_email):
+    """Fetch message details concurrently, one batch HTTP request per BATCH_SIZE messages, as pages are listed."""
     email_details = []
+
+    def fetch_batch(batch):
+        return get_message_details(get_gmail_service(user_email), batch, user_email)
+
     with ThreadPoolExecutor(max_workers=10) as executor:
-        future_to_message = {executor.submit(get_message_details, message['id'], user_email): message for message in messages}
-        for future in as_completed(future_to_message):
-            message = future_to_message[future]
+        future_to_batch = {}
+        message_ids = []
+        for messages in pages:
+            message_ids.extend(message['id'] for message in messages)
+            # Start fetching full batches while the next page is still being listed
+            while len(message_ids) >= BATCH_SIZE:
+                batch, message_ids = message_ids[:BATCH_SIZE], message_ids[BATCH_SIZE:]
+                future_to_batch[executor.submit(fetch_batch, batch)] = batch
+        if message_ids:
+            future_to_batch[executor.submit(fetch_batch, message_ids)] = message_ids
+
+        for future in as_completed(future_to_batch):
+            batch = future_to_batch[future]
             try:
-                details = future.result()
-                if details:
-                    email_details.append(details)
+                email_details.extend(future.result())
             except Exception as exc:
-                logging.error(f"An error occurred while fetching details for message {message['id']} from {user_email}: {exc}")
+                logging.error(f"An error occurred while fetching details for {len(batch)} messages from {user_email}: {exc}")
     return email_details
 
+def process_user(user_email, existing_ids):
+    """Fetch the id and email body of the previous day's messages for one user."""
+    try:
+        print(f"Fetching unique threads for {user_email}...")
+        # Skip messages whose bodies were already loaded by an earlier run
+        pages = ([message for message in messages if message['id'] not in existing_ids]
+                 for messages in list_messages(user_email, max_results=100))
+        email_details = fetch_details_concurrently(pages, user_email)
+        print(f"Found {len(email_details)} for {user_email}.")
+        return email_details
+    except RefreshError as refresh_error:
+        logging.error(f"Failed to refresh credentials for {user_email}: {refresh_error}")
+        print(f"Skipping {user_email} due to authentication issues.")
+        return []
+
+# Connection reused for the lifetime of the process
+_snowflake_conn = None
+
+# Persisted OCSP responses let warm starts skip the certificate revocation round-trips
+OCSP_CACHE_FILE = os.path.expanduser('~/.snowflake/ocsp_cache')
+
 def connect_to_snowflake():
-    """Establish a connection to Snowflake."""
-    return snowflake.connector.connect(
-        user=snowflake_user,
-        password=snowflake_password,
-        account=snowflake_account,
-        warehouse=snowflake_warehouse,
-        database=snowflake_database,
-        schema=snowflake_schema
-    )
+    """Return the process-wide Snowflake connection, establishing it on first use."""
+    global _snowflake_conn
+    if _snowflake_conn is None or _snowflake_conn.is_closed():
+        os.makedirs(os.path.dirname(OCSP_CACHE_FILE), exist_ok=True)
+        _snowflake_conn = snowflake.connector.connect(
+            user=snowflake_user,
+            password=snowflake_password,
+            account=snowflake_account,
+            warehouse=snowflake_warehouse,
+            database=snowflake_database,
+            schema=snowflake_schema,
+            authenticator='snowflake',
+            client_session_keep_alive=True,
+            client_store_temporary_credential=True,
+            ocsp_response_cache_filename=OCSP_CACHE_FILE
+        )
+    return _snowflake_conn
 
 if __name__ == '__main__':
     email_list = os.getenv('EMAILS')
     users = [email.strip() for email in email_list.split(',')] if email_list else []
 
     conn = connect_to_snowflake()
+    existing_ids = load_existing_ids(conn)
     all_email_details = []
 
-    for user_email in users:
-        try:
-            print(f"Fetching unique threads for {user_email}...")
-            messages = list_messages(user_email, max_results=100)
-            print(f"Found {len(messages)} for {user_email}.")
-            
-            email_details = fetch_details_concurrently(messages, user_email)
-            all_email_details.extend(email_details)
-        except RefreshError as refresh_error:
-            logging.error(f"Failed to refresh credentials for {user_email}: {refresh_error}")
-            print(f"Skipping {user_email} due to authentication issues.")
-            continue
+    # Gmail quotas are per user, so mailboxes can be processed in parallel
+    with ThreadPoolExecutor(max_workers=max(1, min(32, len(users)))) as executor:
+        futures = [executor.submit(process_user, user_email, existing_ids) for user_email in users]
+        for future in as_completed(futures):
+            all_email_details.extend(future.result())
 
     save_to_snowflake(all_email_details, conn)
     print('Email details have been saved to the Snowflake EMAIL_BODIES_TEST table.')